@@ -1,9 +1,22 @@
-from flask import Flask, request, jsonify
+# Patch blocking I/O (PyMongo, Redis sockets) so concurrent requests yield to each other
+import eventlet
+eventlet.monkey_patch()
+
+from flask import Flask, request
 from flask_socketio import SocketIO, emit
 from flask_cors import CORS
-from pymongo import MongoClient
-from datetime import datetime, timedelta
-import json
+from pymongo import MongoClient, InsertOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from bson import ObjectId
+import orjson
+import redis
+import atexit
+from collections import deque
+from contextlib import suppress
+from datetime import datetime, timedelta, timezone
+import logging
+import signal
+import sys
 import threading
 import time
 from services.fraud_detector import FraudDetector
@@ -11,20 +24,205 @@ from services.risk_analyzer import RiskAnalyzer
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'fraud_detection_secret_key'
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, async_mode='eventlet', cors_allowed_origins="*")
 CORS(app)
 
+logger = logging.getLogger(__name__)
+
+# Fast JSON responses; orjson serializes datetimes and NumPy values natively
+def json_default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def dump_json(data):
+    return orjson.dumps(data, default=json_default, option=orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY)
+
+def json_response(data, status=200):
+    body = data if isinstance(data, bytes) else dump_json(data)
+    return app.response_class(body, status=status, mimetype='application/json')
+
 # MongoDB connection
-client = MongoClient('mongodb://localhost:27017/')
+# Pool sized for concurrent scoring (above RiskAnalyzer.score_batch's worker count),
+# with warm connections kept open and zstd wire compression
+client = MongoClient(
+    'mongodb://localhost:27017/',
+    maxPoolSize=64,
+    minPoolSize=8,
+    serverSelectionTimeoutMS=5000,
+    compressors='zstd',
+    retryWrites=True
+)
 db = client['fraud_detection']
 transactions_collection = db['transactions']
 users_collection = db['users']
 fraud_patterns_collection = db['fraud_patterns']
 
+# Redis cache for read-heavy dashboard endpoints
+redis_client = redis.Redis(host='localhost', port=6379, db=0)
+DASHBOARD_CACHE_KEY = 'dash:v1'
+DASHBOARD_CACHE_TTL = 10  # seconds; expiry is the only invalidation
+HEAT_MAP_CACHE_TTL = 15  # seconds
+
+# Rolling heat map view: transaction ids scored by time, plus each point's location and risk
+HEAT_MAP_VIEW_KEY = 'heatmap'
+HEAT_MAP_POINTS_KEY = 'heatmap:points'
+HEAT_MAP_SEEDED_KEY = 'heatmap:seeded'
+HEAT_MAP_WINDOW = timedelta(hours=24)
+HEAT_MAP_RISK_THRESHOLD = 0.7
+
+# Partial index covering the heat map's high-risk scan
+HEAT_MAP_INDEX = [('timestamp', -1), ('analysis_result.risk_score', 1)]
+
+# Indexes backing the per-user history, dashboard and heat map queries
+def ensure_indexes():
+    transactions_collection.create_index(
+        [('user_id', 1), ('timestamp', -1), ('amount', 1), ('hour', 1)],
+        name='user_ts_covering'
+    )
+    
+    # Superseded by user_ts_covering, whose (user_id, timestamp) prefix serves
+    # the same queries; nothing reads hour without that timestamp range
+    existing = transactions_collection.index_information()
+    for name in ('user_id_1_timestamp_-1', 'user_id_1_hour_1'):
+        if name in existing:
+            transactions_collection.drop_index(name)
+    
+    transactions_collection.create_index([('timestamp', -1)])
+    
+    # Partial filter must match the heat map's risk_score predicate exactly
+    transactions_collection.create_index(
+        HEAT_MAP_INDEX,
+        partialFilterExpression={'analysis_result.risk_score': {'$gte': 0.7}}
+    )
+    
+    # Flagged/blocked dashboard counts
+    transactions_collection.create_index([('analysis_result.action', 1)])
+
+# Transactions stored before store_transaction() denormalized the hour would
+# land in a null bucket of the risk analyzer's hour histogram; fill them in.
+# Only the histogram's 30-day window matters, which keeps this on the
+# timestamp index and cheap once nothing is left to fix
+def backfill_transaction_hours():
+    transactions_collection.update_many(
+        {
+            'timestamp': {'$gte': datetime.utcnow() - timedelta(days=30)},
+            'hour': {'$exists': False}
+        },
+        [{'$set': {'hour': {'$hour': '$timestamp'}}}]
+    )
+
+ensure_indexes()
+backfill_transaction_hours()
+
 # Initialize fraud detection services
-fraud_detector = FraudDetector(db)
+fraud_detector = FraudDetector(db, cache=redis_client)
 risk_analyzer = RiskAnalyzer(db)
 
+# Buffered transaction writes, flushed in batches by a background task
+WRITE_BATCH_SIZE = 500
+WRITE_BUFFER_LIMIT = 10_000
+WRITE_FLUSH_INTERVAL = 0.05  # seconds
+WRITE_MAX_ATTEMPTS = 5
+WRITE_RETRY_DELAY = 1  # seconds, doubled per consecutive failed flush
+WRITE_MAX_RETRY_DELAY = 30  # seconds
+DUPLICATE_KEY_ERROR = 11000
+write_buffer = deque()  # (document, attempts) pairs
+write_buffer_lock = threading.Lock()
+
+def store_transaction(document):
+    # Denormalize the hour so history aggregations can group on it directly
+    document.setdefault('hour', document['timestamp'].hour)
+    
+    with write_buffer_lock:
+        if len(write_buffer) < WRITE_BUFFER_LIMIT:
+            write_buffer.append((document, 0))
+            return
+    
+    # Buffer is full (flusher behind or Mongo down): apply backpressure by
+    # writing through on the request instead of growing memory without bound
+    transactions_collection.insert_one(document)
+
+def requeue_transaction_writes(batch):
+    retry = []
+    for document, attempts in batch:
+        if attempts + 1 < WRITE_MAX_ATTEMPTS:
+            retry.append((document, attempts + 1))
+        else:
+            logger.error("Dropping transaction %s after %d failed writes",
+                         document.get('transaction_id'), attempts + 1)
+    
+    # Back to the front so retried writes keep their order
+    with write_buffer_lock:
+        write_buffer.extendleft(reversed(retry))
+
+def take_write_batch():
+    with write_buffer_lock:
+        return [write_buffer.popleft() for _ in range(min(len(write_buffer), WRITE_BATCH_SIZE))]
+
+def write_transaction_batch(batch):
+    # Returns False when part of the batch went back to the buffer for a retry
+    try:
+        transactions_collection.bulk_write([InsertOne(document) for document, _ in batch], ordered=False)
+    except BulkWriteError as e:
+        # Unordered batch: everything except the reported indexes was written.
+        # Documents keep the _id assigned on the first attempt, so a duplicate
+        # key means an earlier attempt already landed
+        failed = [error for error in e.details.get('writeErrors', [])
+                  if error.get('code') != DUPLICATE_KEY_ERROR]
+        if failed:
+            logger.warning("Retrying %d of %d transaction writes", len(failed), len(batch))
+            requeue_transaction_writes([batch[error['index']] for error in failed])
+            return False
+    except PyMongoError:
+        logger.exception("Failed to write %d transactions, retrying", len(batch))
+        requeue_transaction_writes(batch)
+        return False
+    return True
+
+def flush_transaction_writes():
+    failures = 0
+    while True:
+        # Back off after a failed flush instead of retrying re-queued writes back to back
+        if failures:
+            socketio.sleep(min(WRITE_RETRY_DELAY * 2 ** (failures - 1), WRITE_MAX_RETRY_DELAY))
+        else:
+            socketio.sleep(WRITE_FLUSH_INTERVAL)
+        
+        # One bad flush must not kill the task, or every later write is lost
+        try:
+            while write_buffer:
+                if not write_transaction_batch(take_write_batch()):
+                    failures += 1
+                    break
+            else:
+                failures = 0
+        except Exception:
+            failures += 1
+            logger.exception("Transaction write flush failed")
+
+def drain_transaction_writes():
+    # Synchronously write whatever is still queued when the process exits
+    # (shutdown, SIGTERM or a reloader restart). One pass only: if MongoDB is
+    # unreachable, record what is lost rather than block the exit on retries
+    while write_buffer:
+        if not write_transaction_batch(take_write_batch()):
+            with write_buffer_lock:
+                lost = [document.get('transaction_id') for document, _ in write_buffer]
+                write_buffer.clear()
+            logger.error("Exiting with %d unwritten transactions: %s", len(lost), lost)
+
+atexit.register(drain_transaction_writes)
+
+# Turn SIGTERM into a normal exit so the drain above runs
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+# Fraud and risk analysis read independent data, so their queries run concurrently
+def run_analyses(transaction):
+    risk_job = eventlet.spawn(risk_analyzer.calculate_risk_score, transaction)
+    fraud_analysis = fraud_detector.analyze_transaction(transaction)
+    return fraud_analysis, risk_job.wait()
+
 @app.route('/api/process-transaction', methods=['POST'])
 def process_transaction():
     try:
@@ -34,8 +232,7 @@ def process_transaction():
         transaction_data['timestamp'] = datetime.utcnow()
         
         # Analyze transaction for fraud
-        fraud_analysis = fraud_detector.analyze_transaction(transaction_data)
-        risk_score = risk_analyzer.calculate_risk_score(transaction_data)
+        fraud_analysis, risk_score = run_analyses(transaction_data)
         
         # Combine analysis results
         result = {
@@ -49,83 +246,173 @@ def process_transaction():
             'timestamp': transaction_data['timestamp'].isoformat()
         }
         
-        # Store transaction
-        transactions_collection.insert_one({
+        # Queue transaction for the next batched write
+        store_transaction({
             **transaction_data,
             'analysis_result': result
         })
+        fraud_detector.record_transaction(transaction_data)
+        risk_analyzer.record_transaction(transaction_data)
+        record_heat_map_point(result)
         
         # Emit real-time update to dashboard
         socketio.emit('transaction_update', result)
         
-        return jsonify(result)
+        return json_response(result)
         
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
 
 @app.route('/api/dashboard-data', methods=['GET'])
 def get_dashboard_data():
     try:
+        cached = redis_client.get(DASHBOARD_CACHE_KEY)
+        if cached:
+            return json_response(cached)
+        
         # Get recent transactions
         recent_transactions = list(transactions_collection.find(
             {'timestamp': {'$gte': datetime.utcnow() - timedelta(hours=24)}}
         ).sort('timestamp', -1).limit(100))
         
-        # Convert ObjectId to string for JSON serialization
-        for transaction in recent_transactions:
-            transaction['_id'] = str(transaction['_id'])
-            transaction['timestamp'] = transaction['timestamp'].isoformat()
-        
-        # Get fraud statistics
+        # Get fraud statistics; the total comes from collection metadata and
+        # both action counts are answered from the analysis_result.action index
         fraud_stats = {
-            'total_transactions': transactions_collection.count_documents({}),
-            'flagged_transactions': transactions_collection.count_documents({
-                'analysis_result.action': {'$in': ['flag', 'block']}
-            }),
-            'blocked_transactions': transactions_collection.count_documents({
-                'analysis_result.action': 'block'
-            })
+            'total_transactions': transactions_collection.estimated_document_count(),
+            'flagged_transactions': transactions_collection.count_documents(
+                {'analysis_result.action': {'$in': ['flag', 'block']}}
+            ),
+            'blocked_transactions': transactions_collection.count_documents(
+                {'analysis_result.action': 'block'}
+            )
         }
         
-        return jsonify({
+        dashboard_data = {
             'recent_transactions': recent_transactions,
             'fraud_stats': fraud_stats
-        })
+        }
+        body = dump_json(dashboard_data)
+        redis_client.setex(DASHBOARD_CACHE_KEY, DASHBOARD_CACHE_TTL, body)
+        
+        return json_response(body)
         
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
+
+def heat_map_entry(result):
+    # Member is derived from the stored result, so re-adding a point is a no-op
+    location = result.get('location') or {}
+    member = f"{result.get('transaction_id')}:{result.get('timestamp')}"
+    point = [location.get('country'), location.get('city'), location.get('lat'),
+             location.get('lng'), result['risk_score']]
+    return member, dump_json(point)
+
+def record_heat_map_point(result):
+    if result['risk_score'] < HEAT_MAP_RISK_THRESHOLD:
+        return
+    
+    member, point = heat_map_entry(result)
+    
+    pipe = redis_client.pipeline()
+    pipe.zadd(HEAT_MAP_VIEW_KEY, {member: time.time()})
+    pipe.hset(HEAT_MAP_POINTS_KEY, member, point)
+    pipe.expire(HEAT_MAP_VIEW_KEY, HEAT_MAP_WINDOW)
+    pipe.expire(HEAT_MAP_POINTS_KEY, HEAT_MAP_WINDOW)
+    
+    # Runs after the transaction is queued, so a Redis error must not fail the
+    # request (a client retry would store it twice). Dropping the seed marker,
+    # when Redis allows it, lets the next read backfill the missed point
+    try:
+        pipe.execute()
+    except redis.RedisError:
+        logger.warning("Failed to record heat map point %s", member, exc_info=True)
+        with suppress(redis.RedisError):
+            redis_client.delete(HEAT_MAP_SEEDED_KEY)
+
+def seed_heat_map_view():
+    # Backfill the window from MongoDB, e.g. after a Redis restart, so the
+    # view never serves less than the aggregation would
+    documents = transactions_collection.find(
+        {
+            'timestamp': {'$gte': datetime.utcnow() - HEAT_MAP_WINDOW},
+            'analysis_result.risk_score': {'$gte': HEAT_MAP_RISK_THRESHOLD}
+        },
+        {
+            '_id': 0,
+            'timestamp': 1,
+            'analysis_result.transaction_id': 1,
+            'analysis_result.timestamp': 1,
+            'analysis_result.location': 1,
+            'analysis_result.risk_score': 1
+        }
+    ).hint(HEAT_MAP_INDEX)
+    
+    pipe = redis_client.pipeline()
+    for document in documents:
+        member, point = heat_map_entry(document['analysis_result'])
+        scored_at = document['timestamp'].replace(tzinfo=timezone.utc).timestamp()
+        pipe.zadd(HEAT_MAP_VIEW_KEY, {member: scored_at})
+        pipe.hset(HEAT_MAP_POINTS_KEY, member, point)
+    pipe.expire(HEAT_MAP_VIEW_KEY, HEAT_MAP_WINDOW)
+    pipe.expire(HEAT_MAP_POINTS_KEY, HEAT_MAP_WINDOW)
+    
+    # Marker goes last: readers only trust the view once the backfill landed
+    pipe.set(HEAT_MAP_SEEDED_KEY, 1, ex=HEAT_MAP_WINDOW)
+    pipe.execute()
+
+def read_heat_map_view():
+    cutoff = time.time() - HEAT_MAP_WINDOW.total_seconds()
+    
+    # Drop points that have aged out of the window
+    expired = redis_client.zrangebyscore(HEAT_MAP_VIEW_KEY, '-inf', f'({cutoff}')
+    if expired:
+        pipe = redis_client.pipeline()
+        pipe.zremrangebyscore(HEAT_MAP_VIEW_KEY, '-inf', f'({cutoff}')
+        pipe.hdel(HEAT_MAP_POINTS_KEY, *expired)
+        pipe.execute()
+    
+    members = redis_client.zrangebyscore(HEAT_MAP_VIEW_KEY, cutoff, '+inf')
+    points = redis_client.hmget(HEAT_MAP_POINTS_KEY, members) if members else []
+    
+    # Group by location, in the $group-style shape the endpoint has always returned
+    groups = {}
+    for raw in points:
+        if raw is None:
+            continue
+        country, city, lat, lng, risk_score = orjson.loads(raw)
+        group = groups.setdefault((country, city, lat, lng), [0, 0.0])
+        group[0] += 1
+        group[1] += risk_score
+    
+    return [
+        {
+            '_id': {'country': country, 'city': city, 'lat': lat, 'lng': lng},
+            'fraud_count': count,
+            'avg_risk_score': total_risk / count
+        }
+        for (country, city, lat, lng), (count, total_risk) in groups.items()
+    ]
 
 @app.route('/api/heat-map-data', methods=['GET'])
 def get_heat_map_data():
     try:
-        # Aggregate fraud attempts by location
-        pipeline = [
-            {
-                '$match': {
-                    'timestamp': {'$gte': datetime.utcnow() - timedelta(hours=24)},
-                    'analysis_result.risk_score': {'$gte': 0.7}
-                }
-            },
-            {
-                '$group': {
-                    '_id': {
-                        'country': '$location.country',
-                        'city': '$location.city',
-                        'lat': '$location.lat',
-                        'lng': '$location.lng'
-                    },
-                    'fraud_count': {'$sum': 1},
-                    'avg_risk_score': {'$avg': '$analysis_result.risk_score'}
-                }
-            }
-        ]
-        
-        heat_map_data = list(transactions_collection.aggregate(pipeline))
-        
-        return jsonify(heat_map_data)
+        cache_key = f"heatmap:v1:{datetime.utcnow().strftime('%Y%m%d%H')}"
+        cached = redis_client.get(cache_key)
+        if cached:
+            return json_response(cached)
+        
+        # Rolling view, backfilled from MongoDB whenever its seed marker is missing
+        if not redis_client.exists(HEAT_MAP_SEEDED_KEY):
+            seed_heat_map_view()
+        heat_map_data = read_heat_map_view()
+        
+        body = dump_json(heat_map_data)
+        redis_client.setex(cache_key, HEAT_MAP_CACHE_TTL, body)
+        
+        return json_response(body)
         
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
 
 # Simulate real-time transaction generation for demo
 def generate_demo_transactions():
@@ -140,7 +427,7 @@ def generate_demo_transactions():
     ]
     
     while True:
-        time.sleep(random.randint(2, 8))  # Random interval between transactions
+        socketio.sleep(random.randint(2, 8))  # Random interval between transactions
         
         transaction = {
             'transaction_id': f"TXN_{int(time.time())}_{random.randint(1000, 9999)}",
@@ -159,33 +446,34 @@ def generate_demo_transactions():
             transaction['merchant'] = 'Unknown Merchant'
         
         # Process transaction
-        with app.test_request_context():
-            fraud_analysis = fraud_detector.analyze_transaction(transaction)
-            risk_score = risk_analyzer.calculate_risk_score(transaction)
-            
-            result = {
-                'transaction_id': transaction['transaction_id'],
-                'confidence_score': fraud_analysis['confidence_score'],
-                'risk_score': risk_score,
-                'action': fraud_analysis['recommended_action'],
-                'flags': fraud_analysis['flags'],
-                'location': transaction['location'],
-                'amount': transaction['amount'],
-                'timestamp': datetime.utcnow().isoformat(),
-                'merchant': transaction['merchant']
-            }
-            
-            transaction['timestamp'] = datetime.utcnow()
-            transactions_collection.insert_one({
-                **transaction,
-                'analysis_result': result
-            })
-            
-            socketio.emit('transaction_update', result)
-
-# Start demo transaction generation in background
-demo_thread = threading.Thread(target=generate_demo_transactions, daemon=True)
-demo_thread.start()
+        fraud_analysis, risk_score = run_analyses(transaction)
+        
+        result = {
+            'transaction_id': transaction['transaction_id'],
+            'confidence_score': fraud_analysis['confidence_score'],
+            'risk_score': risk_score,
+            'action': fraud_analysis['recommended_action'],
+            'flags': fraud_analysis['flags'],
+            'location': transaction['location'],
+            'amount': transaction['amount'],
+            'timestamp': datetime.utcnow().isoformat(),
+            'merchant': transaction['merchant']
+        }
+        
+        transaction['timestamp'] = datetime.utcnow()
+        store_transaction({
+            **transaction,
+            'analysis_result': result
+        })
+        fraud_detector.record_transaction(transaction)
+        risk_analyzer.record_transaction(transaction)
+        record_heat_map_point(result)
+        
+        socketio.emit('transaction_update', result)
+
+# Start batched writes and demo transaction generation as cooperative background tasks
+socketio.start_background_task(flush_transaction_writes)
+socketio.start_background_task(generate_demo_transactions)
 
 if __name__ == '__main__':
     socketio.run(app, debug=True, host='0.0.0.0', port=5000)
@@ -1,11 +1,11 @@
-from datetime import datetime
-from typing import Optional, Dict, List, Any
-from dataclasses import dataclass, asdict
+from datetime import datetime, timedelta
+from typing import Optional, Dict, List, Any, Sequence
+from dataclasses import dataclass
 import json
 import math
 import numpy as np
 
-@dataclass
+@dataclass(slots=True)
 class Location:
     """Geographic location information for a transaction"""
     country: str
@@ -18,7 +18,15 @@ class Location:
    
     
     def to_dict(self) -> Dict[str, Any]:
-        return asdict(self)
+        return {
+            'country': self.country,
+            'city': self.city,
+            'lat': self.lat,
+            'lng': self.lng,
+            'region': self.region,
+            'postal_code': self.postal_code,
+            'ip_address': self.ip_address
+        }
     
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> 'Location':
@@ -39,8 +47,23 @@ class Location:
         r = 6371  # Radius of earth in kilometers
         
         return c * r
+    
+    def distance_to_many(self, lats: Sequence[float], lngs: Sequence[float]) -> np.ndarray:
+        """Calculate distances in kilometers to many points at once (vectorized Haversine)"""
+        lat1 = math.radians(self.lat)
+        lon1 = math.radians(self.lng)
+        lat2 = np.radians(np.asarray(lats, dtype=np.float64))
+        lon2 = np.radians(np.asarray(lngs, dtype=np.float64))
+        
+        dlat = lat2 - lat1
+        dlon = lon2 - lon1
+        a = np.sin(dlat/2)**2 + math.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
+        c = 2 * np.arcsin(np.sqrt(a))
+        r = 6371  # Radius of earth in kilometers
+        
+        return c * r
 
-@dataclass
+@dataclass(slots=True)
 class FraudAnalysis:
     """Results of fraud detection analysis"""
     confidence_score: float
@@ -51,9 +74,14 @@ class FraudAnalysis:
     analysis_timestamp: datetime
     
     def to_dict(self) -> Dict[str, Any]:
-        result = asdict(self)
-        result['analysis_timestamp'] = self.analysis_timestamp.isoformat()
-        return result
+        return {
+            'confidence_score': self.confidence_score,
+            'risk_score': self.risk_score,
+            'recommended_action': self.recommended_action,
+            'flags': list(self.flags),
+            'risk_breakdown': dict(self.risk_breakdown),
+            'analysis_timestamp': self.analysis_timestamp.isoformat()
+        }
     
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> 'FraudAnalysis':
@@ -61,7 +89,7 @@ class FraudAnalysis:
             data['analysis_timestamp'] = datetime.fromisoformat(data['analysis_timestamp'])
         return cls(**data)
 
-@dataclass
+@dataclass(slots=True)
 class Transaction:
     """Main transaction model with all relevant information"""
     transaction_id: str
@@ -91,11 +119,23 @@ class Transaction:
     
     def to_dict(self) -> Dict[str, Any]:
         """Convert transaction to dictionary"""
-        result = asdict(self)
-        result['timestamp'] = self.timestamp.isoformat()
-        if self.fraud_analysis:
-            result['fraud_analysis'] = self.fraud_analysis.to_dict()
-        return result
+        return {
+            'transaction_id': self.transaction_id,
+            'user_id': self.user_id,
+            'amount': self.amount,
+            'merchant': self.merchant,
+            'location': self.location.to_dict(),
+            'timestamp': self.timestamp.isoformat(),
+            'payment_method': self.payment_method,
+            'hour': self.hour,
+            'device_id': self.device_id,
+            'session_id': self.session_id,
+            'card_last_four': self.card_last_four,
+            'currency': self.currency,
+            'category': self.category,
+            'description': self.description,
+            'fraud_analysis': self.fraud_analysis.to_dict() if self.fraud_analysis else None
+        }
     
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> 'Transaction':
@@ -258,7 +298,7 @@ class TransactionRepository:
     
     def find_recent(self, hours: int = 24, limit: int = 100) -> List[Transaction]:
         """Find recent transactions"""
-        cutoff_time = datetime.utcnow() - datetime.timedelta(hours=hours)
+        cutoff_time = datetime.utcnow() - timedelta(hours=hours)
         cursor = self.collection.find({
             'timestamp': {'$gte': cutoff_time}
         }).sort('timestamp', -1).limit(limit)
@@ -269,6 +309,15 @@ class TransactionRepository:
             transactions.append(Transaction.from_dict(data))
         return transactions
     
+    def find_recent_summaries(self, hours: int = 24, limit: int = 100) -> List[Dict[str, Any]]:
+        """Find recent transactions as lean summary dicts (no Transaction construction)"""
+        cutoff_time = datetime.utcnow() - timedelta(hours=hours)
+        cursor = self.collection.find(
+            {'timestamp': {'$gte': cutoff_time}},
+            {'_id': 0, 'transaction_id': 1, 'amount': 1, 'timestamp': 1, 'analysis_result.action': 1}
+        ).sort('timestamp', -1).limit(limit)
+        return list(cursor)
+    
     def find_high_risk(self, limit: int = 50) -> List[Transaction]:
         """Find high-risk transactions"""
         cursor = self.collection.find({
@@ -1,49 +1,104 @@
-import numpy as np
 from datetime import datetime, timedelta
+import json
+import logging
 import math
+import re
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+
+def epoch_ms(timestamp):
+    # Naive UTC datetime to whole milliseconds since the epoch
+    return (timestamp - EPOCH) // timedelta(milliseconds=1)
+
+# Extends a user's seeded amount/location features in one atomic step. A hash
+# created here would hold only this transaction and be read back as the user's
+# whole history, so nothing is written unless the seeded hash still exists.
+# KEYS: amount hash, locations set; ARGV: amount, amount squared, location JSON
+FOLD_FEATURES_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HINCRBY', KEYS[1], 'n', 1)
+redis.call('HINCRBYFLOAT', KEYS[1], 'sum', ARGV[1])
+redis.call('HINCRBYFLOAT', KEYS[1], 'sum_sq', ARGV[2])
+if ARGV[3] ~= '' then
+    redis.call('SADD', KEYS[2], ARGV[3])
+    local ttl = redis.call('PTTL', KEYS[1])
+    if ttl > 0 and redis.call('PTTL', KEYS[2]) == -1 then
+        redis.call('PEXPIRE', KEYS[2], ttl)
+    end
+end
+return 1
+"""
 
 class FraudDetector:
-    def __init__(self, db):
+    def __init__(self, db, cache=None):
         self.db = db
+        self.cache = cache  # Optional Redis client for per-user features
         self.transactions_collection = db['transactions']
         self.users_collection = db['users']
+        
+        # History windows covered by the per-user aggregation
+        self.history_window = timedelta(days=90)
+        self.amount_window = timedelta(days=30)
+        self.frequency_window = timedelta(hours=1)
+        
+        # Absolute lifetime of the cached amount/location features. Set once
+        # when seeded and never extended, so they are rebuilt from the real
+        # windows instead of accumulating into lifetime stats
+        self.feature_lifetime = timedelta(days=1)
+        
+        # Known safe merchants matched in one regex pass
+        self._safe_re = re.compile(r'\b(amazon|walmart|target|best\s*buy|apple|google)\b', re.IGNORECASE)
+        self._unknown_merchants = frozenset({'unknown merchant', ''})
     
     def analyze_transaction(self, transaction):
         flags = []
-        risk_factors = []
+        
+        # Window cutoffs go into $match as datetime literals. Never express them
+        # with $expr/$$NOW/$subtract: the planner can't use the (user_id, timestamp)
+        # index for those and falls back to scanning the user's documents.
+        now = datetime.utcnow()
+        cutoffs = {
+            'history': now - self.history_window,
+            'amount': now - self.amount_window,
+            'frequency': now - self.frequency_window
+        }
+        
+        # Fetch the user's history once for all history-based checks
+        history = self._load_user_history(transaction.get('user_id'), cutoffs)
         
         # Amount-based analysis
-        amount_risk = self._analyze_amount(transaction)
-        risk_factors.append(amount_risk)
+        amount_risk = self._analyze_amount(transaction, history)
         if amount_risk > 0.7:
             flags.append("High amount transaction")
         
         # Time-based analysis
         time_risk = self._analyze_time(transaction)
-        risk_factors.append(time_risk)
         if time_risk > 0.6:
             flags.append("Unusual transaction time")
         
         # Location-based analysis
-        location_risk = self._analyze_location(transaction)
-        risk_factors.append(location_risk)
+        location_risk = self._analyze_location(transaction, history)
         if location_risk > 0.5:
             flags.append("New or suspicious location")
         
         # Frequency analysis
-        frequency_risk = self._analyze_frequency(transaction)
-        risk_factors.append(frequency_risk)
+        frequency_risk = self._analyze_frequency(transaction, history)
         if frequency_risk > 0.8:
             flags.append("High frequency transactions")
         
         # Merchant analysis
         merchant_risk = self._analyze_merchant(transaction)
-        risk_factors.append(merchant_risk)
         if merchant_risk > 0.7:
             flags.append("Unknown or risky merchant")
         
         # Calculate overall confidence score
-        confidence_score = np.mean(risk_factors) if risk_factors else 0.0
+        confidence_score = (amount_risk + time_risk + location_risk +
+                            frequency_risk + merchant_risk) / 5.0
         
         # Determine recommended action
         if confidence_score >= 0.8:
@@ -66,26 +121,194 @@ class FraudDetector:
             }
         }
     
-    def _analyze_amount(self, transaction):
-        amount = transaction.get('amount', 0)
+    def _load_user_history(self, user_id, cutoffs):
+        if not user_id:
+            return None
         
-        # Get user's transaction history
-        user_id = transaction.get('user_id')
-        if user_id:
-            recent_transactions = list(self.transactions_collection.find({
+        # Serve from the Redis feature cache, rebuilding from MongoDB on a miss.
+        # The cache is an accelerator only: if Redis is down, score from MongoDB
+        if self.cache is not None:
+            try:
+                history = self._get_cached_history(user_id, cutoffs)
+            except RedisError:
+                logger.warning("Feature cache read failed for user %s", user_id, exc_info=True)
+                history = None
+            if history is not None:
+                return history
+        
+        history = self._query_user_history(user_id, cutoffs)
+        
+        if self.cache is not None:
+            try:
+                self._cache_history(user_id, history)
+            except RedisError:
+                logger.warning("Feature cache seed failed for user %s", user_id, exc_info=True)
+        
+        return history
+    
+    def _query_user_history(self, user_id, cutoffs):
+        # Amount stats, known locations and the last hour's transactions in one round-trip
+        pipeline = [
+            {'$match': {
                 'user_id': user_id,
-                'timestamp': {'$gte': datetime.utcnow() - timedelta(days=30)}
-            }))
+                'timestamp': {'$gte': cutoffs['history']}
+            }},
+            # Only carry the fields the facets read
+            {'$project': {
+                '_id': 0,
+                'transaction_id': 1,
+                'timestamp': 1,
+                'amount': 1,
+                'location.country': 1,
+                'location.city': 1
+            }},
+            {'$facet': {
+                'amt': [
+                    {'$match': {'timestamp': {'$gte': cutoffs['amount']}}},
+                    {'$group': {
+                        '_id': None,
+                        'avg': {'$avg': '$amount'},
+                        'std': {'$stdDevPop': '$amount'},
+                        'n': {'$sum': 1}
+                    }}
+                ],
+                'loc': [
+                    {'$group': {'_id': {'c': '$location.country', 'ci': '$location.city'}}}
+                ],
+                'freq': [
+                    {'$match': {'timestamp': {'$gte': cutoffs['frequency']}}},
+                    {'$project': {'transaction_id': 1, 'timestamp': 1}}
+                ]
+            }}
+        ]
+        
+        facets = next(self.transactions_collection.aggregate(pipeline))
+        
+        return {
+            'amount_stats': facets['amt'][0] if facets['amt'] else None,
+            'known_locations': frozenset(
+                (loc['_id'].get('c'), loc['_id'].get('ci')) for loc in facets['loc']
+            ),
+            'count_1h': len(facets['freq']),
+            'recent_transactions': facets['freq']
+        }
+    
+    def _cache_keys(self, user_id):
+        return f"u:{user_id}:amt", f"u:{user_id}:locs", f"u:{user_id}:txns1h"
+    
+    def _recent_entry(self, transaction):
+        # Sorted set member/score for the sliding frequency window. Scores are
+        # whole milliseconds, the precision MongoDB stores, so a transaction
+        # recorded live and later re-seeded from MongoDB maps to the same member
+        timestamp = transaction.get('timestamp') or datetime.utcnow()
+        ms = epoch_ms(timestamp)
+        return f"{transaction.get('transaction_id')}:{ms}", ms
+    
+    def _get_cached_history(self, user_id, cutoffs):
+        amt_key, locs_key, recent_key = self._cache_keys(user_id)
+        
+        pipe = self.cache.pipeline()
+        pipe.hgetall(amt_key)
+        pipe.smembers(locs_key)
+        pipe.zcount(recent_key, epoch_ms(cutoffs['frequency']), '+inf')
+        amt, locs, count_1h = pipe.execute()
+        
+        if not amt:
+            return None
+        
+        # Mean and std derived from the running n / sum / sum of squares
+        n = int(amt[b'n'])
+        amount_stats = None
+        if n > 0:
+            avg = float(amt[b'sum']) / n
+            variance = max(float(amt[b'sum_sq']) / n - avg ** 2, 0.0)
+            amount_stats = {'avg': avg, 'std': math.sqrt(variance), 'n': n}
+        
+        known_locations = frozenset(tuple(json.loads(member)) for member in locs)
+        
+        return {
+            'amount_stats': amount_stats,
+            'known_locations': known_locations,
+            'count_1h': count_1h
+        }
+    
+    def _cache_history(self, user_id, history):
+        amt_key, locs_key, recent_key = self._cache_keys(user_id)
+        
+        stats = history['amount_stats']
+        if stats and stats['avg'] is not None:
+            n = stats['n']
+            amt = {
+                'n': n,
+                'sum': stats['avg'] * n,
+                'sum_sq': n * (stats['std'] ** 2 + stats['avg'] ** 2)
+            }
+        else:
+            amt = {'n': 0, 'sum': 0, 'sum_sq': 0}
+        
+        pipe = self.cache.pipeline()
+        pipe.hset(amt_key, mapping=amt)
+        pipe.expire(amt_key, self.feature_lifetime)
+        
+        if history['known_locations']:
+            pipe.sadd(locs_key, *[
+                json.dumps([country, city])
+                for country, city in history['known_locations']
+            ])
+            pipe.expire(locs_key, self.feature_lifetime)
+        
+        # Merged with anything recorded live, e.g. writes still buffered in the app
+        if history['recent_transactions']:
+            pipe.zadd(recent_key, dict(map(self._recent_entry, history['recent_transactions'])))
+            pipe.expire(recent_key, self.frequency_window)
+        
+        pipe.execute()
+    
+    def record_transaction(self, transaction):
+        # Fold a stored transaction into the cached features until they expire
+        user_id = transaction.get('user_id')
+        if self.cache is None or not user_id:
+            return
+        
+        amt_key, locs_key, recent_key = self._cache_keys(user_id)
+        amount = transaction.get('amount', 0)
+        location = transaction.get('location') or {}
+        member, ms = self._recent_entry(transaction)
+        
+        # EVAL rather than a registered Script: the pipeline then stays one
+        # round-trip, and Redis caches the compiled script by its digest
+        pipe = self.cache.pipeline()
+        pipe.eval(
+            FOLD_FEATURES_SCRIPT, 2, amt_key, locs_key,
+            amount, amount ** 2,
+            json.dumps([location.get('country'), location.get('city')]) if location else ''
+        )
+        
+        # Sliding one-hour window: add this transaction, drop those older than an hour
+        window_ms = int(self.frequency_window.total_seconds() * 1000)
+        pipe.zadd(recent_key, {member: ms})
+        pipe.zremrangebyscore(recent_key, '-inf', f'({ms - window_ms}')
+        pipe.expire(recent_key, self.frequency_window)
+        
+        # A failed cache write must not fail a transaction that is already queued
+        try:
+            pipe.execute()
+        except RedisError:
+            logger.warning("Feature cache update failed for user %s", user_id, exc_info=True)
+    
+    def _analyze_amount(self, transaction, history):
+        amount = transaction.get('amount', 0)
+        
+        # Compare against the user's 30-day amount stats
+        stats = history['amount_stats'] if history else None
+        if stats and stats['avg'] is not None:
+            avg_amount = stats['avg']
+            std_amount = stats['std'] if stats['n'] > 1 else avg_amount * 0.5
             
-            if recent_transactions:
-                amounts = [t.get('amount', 0) for t in recent_transactions]
-                avg_amount = np.mean(amounts)
-                std_amount = np.std(amounts) if len(amounts) > 1 else avg_amount * 0.5
-                
-                # Z-score based risk
-                if std_amount > 0:
-                    z_score = abs(amount - avg_amount) / std_amount
-                    return min(z_score / 3.0, 1.0)  # Normalize to 0-1
+            # Z-score based risk
+            if std_amount > 0:
+                z_score = abs(amount - avg_amount) / std_amount
+                return min(z_score / 3.0, 1.0)  # Normalize to 0-1
         
         # Default risk based on absolute amount
         if amount > 5000:
@@ -97,7 +320,8 @@ class FraudDetector:
         return 0.1
     
     def _analyze_time(self, transaction):
-        hour = transaction.get('hour', datetime.utcnow().hour)
+        # Only read the clock when the transaction carries no hour
+        hour = transaction['hour'] if 'hour' in transaction else datetime.utcnow().hour
         
         # Higher risk for transactions between 11 PM and 5 AM
         if hour >= 23 or hour <= 5:
@@ -106,41 +330,30 @@ class FraudDetector:
             return 0.4
         return 0.1
     
-    def _analyze_location(self, transaction):
+    def _analyze_location(self, transaction, history):
         location = transaction.get('location', {})
-        user_id = transaction.get('user_id')
         
-        if not location or not user_id:
+        if not location or not history:
             return 0.5
         
-        # Check if this is a new location for the user
-        recent_locations = list(self.transactions_collection.find({
-            'user_id': user_id,
-            'timestamp': {'$gte': datetime.utcnow() - timedelta(days=90)}
-        }))
+        # Locations seen for the user over the last 90 days
+        known_locations = history['known_locations']
         
-        if not recent_locations:
+        if not known_locations:
             return 0.7  # New user, moderate risk
         
         # Check if current location has been used before
-        for txn in recent_locations:
-            txn_location = txn.get('location', {})
-            if (txn_location.get('country') == location.get('country') and
-                txn_location.get('city') == location.get('city')):
-                return 0.1  # Familiar location
+        if (location.get('country'), location.get('city')) in known_locations:
+            return 0.1  # Familiar location
         
         return 0.8  # New location
     
-    def _analyze_frequency(self, transaction):
-        user_id = transaction.get('user_id')
-        if not user_id:
+    def _analyze_frequency(self, transaction, history):
+        if not history:
             return 0.3
         
-        # Count transactions in the last hour
-        recent_count = self.transactions_collection.count_documents({
-            'user_id': user_id,
-            'timestamp': {'$gte': datetime.utcnow() - timedelta(hours=1)}
-        })
+        # Transactions in the last hour
+        recent_count = history['count_1h']
         
         if recent_count >= 5:
             return 1.0
@@ -153,12 +366,9 @@ class FraudDetector:
     def _analyze_merchant(self, transaction):
         merchant = transaction.get('merchant', '').lower()
         
-        # List of known safe merchants
-        safe_merchants = ['amazon', 'walmart', 'target', 'best buy', 'apple', 'google']
-        
-        if any(safe in merchant for safe in safe_merchants):
+        if self._safe_re.search(merchant):
             return 0.1
-        elif merchant == 'unknown merchant' or not merchant:
+        elif merchant in self._unknown_merchants:
             return 0.9
         else:
             return 0.5
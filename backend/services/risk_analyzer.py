@@ -1,122 +1,297 @@
-import math
+from bisect import bisect_left, bisect_right
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+import math
+import numpy as np
+import threading
+
+# High-risk countries (simplified list), matched exactly on the normalized name
+HIGH_RISK_COUNTRIES = frozenset({'unknown', 'tor', 'proxy'})
+MEDIUM_RISK_COUNTRIES = frozenset({'nigeria', 'russia', 'china', 'iran', 'north korea'})
+
+# Piecewise risk ladders: risks[i] applies between thresholds[i-1] and thresholds[i].
+# Velocity counts are inclusive (>=, bisect_right); z-score and hour frequency
+# thresholds are strict (>, bisect_left). Index 0 of the hourly velocity ladder
+# falls through to the daily one.
+VELOCITY_1H_THRESHOLDS = (5, 10)
+VELOCITY_1H_RISKS = (None, 0.8, 1.0)
+VELOCITY_24H_THRESHOLDS = (20, 50)
+VELOCITY_24H_RISKS = (0.1, 0.4, 0.7)
+Z_SCORE_THRESHOLDS = (1, 2, 3)
+Z_SCORE_RISKS = (0.1, 0.3, 0.7, 1.0)
+HOUR_FREQUENCY_THRESHOLDS = (0.05, 0.1)
+
+# Component weights: velocity, geographic, amount deviation, time pattern, device
+RISK_WEIGHTS = (0.25, 0.2, 0.3, 0.15, 0.1)
+
+# Risk by payment method
+METHOD_RISKS = {
+    'credit_card': 0.1,
+    'debit_card': 0.2,
+    'digital_wallet': 0.15,
+    'cryptocurrency': 0.8,
+    'wire_transfer': 0.6,
+    'unknown': 0.9
+}
+
+def window_cutoffs(now):
+    # History window boundaries, computed once per scoring call
+    return {
+        '1h': now - timedelta(hours=1),
+        '24h': now - timedelta(hours=24),
+        '30d': now - timedelta(days=30),
+        '60d': now - timedelta(days=60)
+    }
 
 class RiskAnalyzer:
     def __init__(self, db):
         self.db = db
         self.transactions_collection = db['transactions']
+        
+        # Per-user historical stats shared by the scoring components; kept
+        # current by record_transaction so cached velocity sees new bursts
+        self._user_stats_cache = TTLCache(maxsize=10_000, ttl=30)
+        self._user_stats_lock = threading.Lock()
     
     def calculate_risk_score(self, transaction):
-        risk_components = []
+        now = datetime.utcnow()
+        
+        # Load the user's historical stats once for every component
+        user_id = transaction.get('user_id')
+        stats = self._load_user_stats(user_id, window_cutoffs(now)) if user_id else None
         
+        return self._score(transaction, stats, now.hour)
+    
+    def _score(self, transaction, stats, current_hour):
         # Velocity risk (transaction frequency)
-        velocity_risk = self._calculate_velocity_risk(transaction)
-        risk_components.append(velocity_risk * 0.25)
+        velocity_risk = self._calculate_velocity_risk(stats)
         
         # Geographic risk
         geo_risk = self._calculate_geographic_risk(transaction)
-        risk_components.append(geo_risk * 0.2)
         
         # Amount deviation risk
-        amount_risk = self._calculate_amount_deviation_risk(transaction)
-        risk_components.append(amount_risk * 0.3)
+        amount_risk = self._calculate_amount_deviation_risk(transaction, stats)
         
         # Time pattern risk
-        time_risk = self._calculate_time_pattern_risk(transaction)
-        risk_components.append(time_risk * 0.15)
+        time_risk = self._calculate_time_pattern_risk(transaction, stats, current_hour)
         
         # Device/method risk
         device_risk = self._calculate_device_risk(transaction)
-        risk_components.append(device_risk * 0.1)
         
-        return min(sum(risk_components), 1.0)
+        w_velocity, w_geo, w_amount, w_time, w_device = RISK_WEIGHTS
+        total = (w_velocity * velocity_risk + w_geo * geo_risk + w_amount * amount_risk +
+                 w_time * time_risk + w_device * device_risk)
+        return total if total < 1.0 else 1.0
+    
+    def score_batch(self, transactions, max_workers=16):
+        now = datetime.utcnow()
+        user_stats = self._load_batch_stats(transactions, window_cutoffs(now), max_workers)
+        return [self._score(t, user_stats.get(t.get('user_id')), now.hour) for t in transactions]
     
-    def _calculate_velocity_risk(self, transaction):
+    def calculate_risk_scores(self, transactions, max_workers=16):
+        # Vectorized equivalent of calculate_risk_score for backfills and replays
+        now = datetime.utcnow()
+        user_stats = self._load_batch_stats(transactions, window_cutoffs(now), max_workers)
+        stats = [user_stats.get(t.get('user_id')) for t in transactions]
+        has_user = np.array([s is not None for s in stats], dtype=bool)
+        
+        # Velocity risk
+        count_1h = np.array([s['count_1h'] if s else 0 for s in stats])
+        count_24h = np.array([s['count_24h'] if s else 0 for s in stats])
+        hourly_level = np.searchsorted(VELOCITY_1H_THRESHOLDS, count_1h, side='right')
+        velocity_risk = np.where(
+            hourly_level > 0,
+            np.take((0.0,) + VELOCITY_1H_RISKS[1:], hourly_level),
+            np.take(VELOCITY_24H_RISKS, np.searchsorted(VELOCITY_24H_THRESHOLDS, count_24h, side='right'))
+        )
+        velocity_risk = np.where(has_user, velocity_risk, 0.5)
+        
+        # Geographic and device risk are per-row lookups
+        geo_risk = np.array([self._calculate_geographic_risk(t) for t in transactions], dtype=np.float64)
+        device_risk = np.array([self._calculate_device_risk(t) for t in transactions], dtype=np.float64)
+        
+        # Amount deviation risk
+        amount_stats = [s['amount_stats'] if s else None for s in stats]
+        amounts = np.array([t.get('amount', 0) for t in transactions], dtype=np.float64)
+        n = np.array([a['n'] if a else 0 for a in amount_stats])
+        avg = np.array([a['avg'] if a else 0.0 for a in amount_stats], dtype=np.float64)
+        sd = np.array([a['sd'] if a else 0.0 for a in amount_stats], dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z_scores = np.abs(amounts - avg) / sd
+        amount_risk = np.where(
+            sd == 0,
+            np.where(amounts != avg, 0.8, 0.1),
+            np.take(Z_SCORE_RISKS, np.searchsorted(Z_SCORE_THRESHOLDS, z_scores, side='left'))
+        )
+        amount_risk = np.where(n < 3, 0.4, amount_risk)
+        amount_risk = np.where(has_user, amount_risk, 0.3)
+        
+        # Time pattern risk
+        hour_list = [t.get('hour', now.hour) for t in transactions]
+        hours = np.array(hour_list)
+        base_risk = np.where(
+            (hours >= 2) & (hours <= 5), 0.9,
+            np.where(((hours >= 22) & (hours <= 23)) | ((hours >= 6) & (hours <= 7)), 0.4, 0.1)
+        )
+        totals = np.array([sum(s['hour_counts'].values()) if s else 0 for s in stats])
+        hour_counts = np.array([s['hour_counts'].get(h, 0) if s else 0 for s, h in zip(stats, hour_list)])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            hour_frequency = hour_counts / totals
+        frequency_level = np.searchsorted(HOUR_FREQUENCY_THRESHOLDS, hour_frequency, side='left')
+        time_risk = np.where(frequency_level == 2, 0.1, np.where(frequency_level == 1, 0.3, base_risk))
+        time_risk = np.where(has_user & (totals >= 5), time_risk, base_risk)
+        
+        w_velocity, w_geo, w_amount, w_time, w_device = RISK_WEIGHTS
+        total = (w_velocity * velocity_risk + w_geo * geo_risk + w_amount * amount_risk +
+                 w_time * time_risk + w_device * device_risk)
+        return np.minimum(total, 1.0).tolist()
+    
+    def _load_batch_stats(self, transactions, cutoffs, max_workers):
+        # The stats load is the only I/O: fetch each distinct user's stats
+        # concurrently, so the batch can then be scored in-process
+        user_ids = list({t.get('user_id') for t in transactions if t.get('user_id')})
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            loaded = executor.map(lambda user_id: self._load_user_stats(user_id, cutoffs), user_ids)
+            return dict(zip(user_ids, loaded))
+    
+    def record_transaction(self, transaction):
+        # Fold a stored transaction into its user's cached stats, if any
         user_id = transaction.get('user_id')
         if not user_id:
-            return 0.5
+            return
         
-        # Count transactions in various time windows
-        now = datetime.utcnow()
+        amount = transaction.get('amount') or 0
+        timestamp = transaction.get('timestamp') or datetime.utcnow()
+        hour = transaction.get('hour', timestamp.hour)
         
-        count_1h = self.transactions_collection.count_documents({
-            'user_id': user_id,
-            'timestamp': {'$gte': now - timedelta(hours=1)}
-        })
+        with self._user_stats_lock:
+            stats = self._user_stats_cache.get(user_id)
+            if stats is None:
+                return
+            
+            # Running population mean/std update (Welford)
+            amount_stats = stats['amount_stats'] or {'n': 0, 'avg': 0.0, 'sd': 0.0}
+            n = amount_stats['n'] + 1
+            delta = amount - amount_stats['avg']
+            avg = amount_stats['avg'] + delta / n
+            m2 = amount_stats['sd'] ** 2 * amount_stats['n'] + delta * (amount - avg)
+            
+            hour_counts = dict(stats['hour_counts'])
+            hour_counts[hour] = hour_counts.get(hour, 0) + 1
+            
+            # Replace rather than mutate, callers may still hold the old entry
+            self._user_stats_cache[user_id] = {
+                'count_1h': stats['count_1h'] + 1,
+                'count_24h': stats['count_24h'] + 1,
+                'amount_stats': {'n': n, 'avg': avg, 'sd': math.sqrt(max(m2, 0.0) / n)},
+                'hour_counts': hour_counts
+            }
+    
+    def _load_user_stats(self, user_id, cutoffs):
+        with self._user_stats_lock:
+            stats = self._user_stats_cache.get(user_id)
+        if stats is not None:
+            return stats
         
-        count_24h = self.transactions_collection.count_documents({
-            'user_id': user_id,
-            'timestamp': {'$gte': now - timedelta(hours=24)}
-        })
+        # Velocity counts, amount stats and hour histogram in one aggregation
+        facets = next(self.transactions_collection.aggregate([
+            {'$match': {
+                'user_id': user_id,
+                'timestamp': {'$gte': cutoffs['60d']}
+            }},
+            # Only indexed fields, so the user_ts_covering index can answer without fetches
+            {'$project': {'_id': 0, 'timestamp': 1, 'amount': 1, 'hour': 1}},
+            {'$facet': {
+                'vel': [
+                    {'$match': {'timestamp': {'$gte': cutoffs['24h']}}},
+                    {'$group': {
+                        '_id': None,
+                        'count_24h': {'$sum': 1},
+                        'count_1h': {'$sum': {
+                            '$cond': [{'$gte': ['$timestamp', cutoffs['1h']]}, 1, 0]
+                        }}
+                    }}
+                ],
+                'amt': [
+                    {'$group': {
+                        '_id': None,
+                        'n': {'$sum': 1},
+                        'avg': {'$avg': {'$ifNull': ['$amount', 0]}},
+                        'sd': {'$stdDevPop': {'$ifNull': ['$amount', 0]}}
+                    }}
+                ],
+                'hours': [
+                    {'$match': {'timestamp': {'$gte': cutoffs['30d']}}},
+                    {'$group': {
+                        '_id': '$hour',
+                        'c': {'$sum': 1}
+                    }}
+                ]
+            }}
+        ]))
+        
+        velocity = facets['vel'][0] if facets['vel'] else {}
+        stats = {
+            'count_1h': velocity.get('count_1h', 0),
+            'count_24h': velocity.get('count_24h', 0),
+            'amount_stats': facets['amt'][0] if facets['amt'] else None,
+            'hour_counts': {bucket['_id']: bucket['c'] for bucket in facets['hours']}
+        }
+        
+        with self._user_stats_lock:
+            self._user_stats_cache[user_id] = stats
+        
+        return stats
+    
+    def _calculate_velocity_risk(self, stats):
+        if not stats:
+            return 0.5
+        
+        count_1h = stats['count_1h']
+        count_24h = stats['count_24h']
         
         # Risk based on velocity
-        if count_1h >= 10:
-            return 1.0
-        elif count_1h >= 5:
-            return 0.8
-        elif count_24h >= 50:
-            return 0.7
-        elif count_24h >= 20:
-            return 0.4
-        else:
-            return 0.1
+        hourly_level = bisect_right(VELOCITY_1H_THRESHOLDS, count_1h)
+        if hourly_level:
+            return VELOCITY_1H_RISKS[hourly_level]
+        return VELOCITY_24H_RISKS[bisect_right(VELOCITY_24H_THRESHOLDS, count_24h)]
     
     def _calculate_geographic_risk(self, transaction):
         location = transaction.get('location', {})
-        country = location.get('country', '').lower()
-        
-        # High-risk countries (simplified list)
-        high_risk_countries = ['unknown', 'tor', 'proxy']
-        medium_risk_countries = ['nigeria', 'russia', 'china', 'iran', 'north korea']
+        country = location.get('country', '').strip().lower()
         
-        if any(risk in country for risk in high_risk_countries):
+        if country in HIGH_RISK_COUNTRIES:
             return 1.0
-        elif any(risk in country for risk in medium_risk_countries):
+        elif country in MEDIUM_RISK_COUNTRIES:
             return 0.6
         else:
             return 0.2
     
-    def _calculate_amount_deviation_risk(self, transaction):
+    def _calculate_amount_deviation_risk(self, transaction, stats):
         amount = transaction.get('amount', 0)
-        user_id = transaction.get('user_id')
         
-        if not user_id:
+        if not stats:
             return 0.3
         
-        # Get historical transaction amounts
-        historical = list(self.transactions_collection.find({
-            'user_id': user_id,
-            'timestamp': {'$gte': datetime.utcnow() - timedelta(days=60)}
-        }))
+        # Historical amount statistics
+        amount_stats = stats['amount_stats']
         
-        if len(historical) < 3:
+        if not amount_stats or amount_stats['n'] < 3:
             return 0.4  # Limited history
         
-        amounts = [t.get('amount', 0) for t in historical]
-        avg_amount = sum(amounts) / len(amounts)
-        
-        # Calculate standard deviation
-        variance = sum((x - avg_amount) ** 2 for x in amounts) / len(amounts)
-        std_dev = math.sqrt(variance)
+        avg_amount = amount_stats['avg']
+        std_dev = amount_stats['sd']
         
         if std_dev == 0:
             return 0.8 if amount != avg_amount else 0.1
         
         # Z-score calculation
         z_score = abs(amount - avg_amount) / std_dev
-        
-        if z_score > 3:
-            return 1.0
-        elif z_score > 2:
-            return 0.7
-        elif z_score > 1:
-            return 0.3
-        else:
-            return 0.1
+        return Z_SCORE_RISKS[bisect_left(Z_SCORE_THRESHOLDS, z_score)]
     
-    def _calculate_time_pattern_risk(self, transaction):
-        hour = transaction.get('hour', datetime.utcnow().hour)
-        user_id = transaction.get('user_id')
+    def _calculate_time_pattern_risk(self, transaction, stats, current_hour):
+        hour = transaction.get('hour', current_hour)
         
         # Base risk by hour
         if 2 <= hour <= 5:  # Very unusual hours
@@ -126,42 +301,22 @@ class RiskAnalyzer:
         else:
             base_risk = 0.1
         
-        if not user_id:
+        if not stats:
             return base_risk
         
-        # Check user's historical patterns
-        historical = list(self.transactions_collection.find({
-            'user_id': user_id,
-            'timestamp': {'$gte': datetime.utcnow() - timedelta(days=30)}
-        }))
+        # Check user's historical patterns as an hour histogram
+        hour_counts = stats['hour_counts']
         
-        if len(historical) < 5:
+        total = sum(hour_counts.values())
+        if total < 5:
             return base_risk
         
         # Check if this hour is common for this user
-        user_hours = [t.get('hour', datetime.utcfromtimestamp(t['timestamp'].timestamp()).hour) 
-                      for t in historical]
-        
-        hour_frequency = user_hours.count(hour) / len(user_hours)
+        hour_frequency = hour_counts.get(hour, 0) / total
         
-        if hour_frequency > 0.1:  # User commonly transacts at this hour
-            return 0.1
-        elif hour_frequency > 0.05:
-            return 0.3
-        else:
-            return base_risk
+        # Rarely seen hours keep the base risk; common ones (> 10%) drop to 0.1
+        return (base_risk, 0.3, 0.1)[bisect_left(HOUR_FREQUENCY_THRESHOLDS, hour_frequency)]
     
     def _calculate_device_risk(self, transaction):
         payment_method = transaction.get('payment_method', '').lower()
-        
-        # Risk by payment method
-        method_risks = {
-            'credit_card': 0.1,
-            'debit_card': 0.2,
-            'digital_wallet': 0.15,
-            'cryptocurrency': 0.8,
-            'wire_transfer': 0.6,
-            'unknown': 0.9
-        }
-        
-        return method_risks.get(payment_method, 0.5)
+        return METHOD_RISKS.get(payment_method, 0.5)
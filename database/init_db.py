@@ -1,10 +1,18 @@
 from pymongo import MongoClient
 from datetime import datetime, timedelta
-import random
+from itertools import islice
+import numpy as np
 
 def initialize_database():
     # Connect to MongoDB
-    client = MongoClient('mongodb://localhost:27017/')
+    client = MongoClient(
+        'mongodb://localhost:27017/',
+        maxPoolSize=64,
+        minPoolSize=8,
+        serverSelectionTimeoutMS=5000,
+        compressors='zstd',
+        retryWrites=True
+    )
     db = client['fraud_detection']
     
     # Clear existing collections
@@ -18,9 +26,17 @@ def initialize_database():
     fraud_patterns = db.fraud_patterns
     
     # Create indexes for better performance
-    transactions.create_index([('user_id', 1), ('timestamp', -1)])
+    transactions.create_index(
+        [('user_id', 1), ('timestamp', -1), ('amount', 1), ('hour', 1)],
+        name='user_ts_covering'
+    )
     transactions.create_index([('timestamp', -1)])
     transactions.create_index([('analysis_result.risk_score', -1)])
+    transactions.create_index(
+        [('timestamp', -1), ('analysis_result.risk_score', 1)],
+        partialFilterExpression={'analysis_result.risk_score': {'$gte': 0.7}}
+    )
+    transactions.create_index([('analysis_result.action', 1)])
     transactions.create_index([('location.country', 1)])
     
     users.create_index([('user_id', 1)])
@@ -64,12 +80,18 @@ def initialize_database():
     
     fraud_patterns.insert_many(sample_patterns)
     
-    # Insert sample users
-    sample_users = []
-    for i in range(1000, 2000):
-        user = {
+    # Insert sample users, drawing all random fields up front
+    user_ids = range(1000, 2000)
+    rng = np.random.default_rng()
+    account_ages = rng.integers(30, 366, len(user_ids)).tolist()
+    risk_scores = rng.uniform(0.1, 0.3, len(user_ids)).tolist()  # Most users are low risk
+    now = datetime.utcnow()
+    
+    # Users are generated lazily and inserted in bounded batches
+    sample_users = (
+        {
             'user_id': f'USER_{i}',
-            'created_at': datetime.utcnow() - timedelta(days=random.randint(30, 365)),
+            'created_at': now - timedelta(days=age),
             'profile': {
                 'typical_amount_range': [50, 500],
                 'common_locations': [
@@ -79,15 +101,22 @@ def initialize_database():
                 'common_hours': list(range(9, 22)),  # 9 AM to 9 PM
                 'preferred_merchants': ['Amazon', 'Walmart', 'Target']
             },
-            'risk_score': random.uniform(0.1, 0.3)  # Most users are low risk
+            'risk_score': score
         }
-        sample_users.append(user)
+        for i, age, score in zip(user_ids, account_ages, risk_scores)
+    )
     
-    users.insert_many(sample_users)
+    users_created = 0
+    while True:
+        batch = list(islice(sample_users, 500))
+        if not batch:
+            break
+        users.insert_many(batch, ordered=False)
+        users_created += len(batch)
     
     print("Database initialized successfully!")
     print(f"Created {len(sample_patterns)} fraud patterns")
-    print(f"Created {len(sample_users)} sample users")
+    print(f"Created {users_created} sample users")
     
     return db
 